@@ -1,9 +1,94 @@
+from timeit import default_timer as timer  # Import 'timer' for the time budget of an explanation.
+
 from z3 import *
 
+# Relaxation costs used when searching for the cheapest way to make an UNSAT instance feasible.
+# Dropping a single data fact (one enrolment, one exam's room capacity) is a local fix for the planner,
+# while dropping a whole constraint group weakens the rules for every exam, so it is priced higher.
+# Assertions with no cost are never dropped, e.g. dropping Constraint 1 would trivially leave every exam unscheduled.
+FACT_RELAXATION_COST = 1
+GROUP_RELAXATION_COST = 5
+NOT_RELAXABLE = None
+
+# Time budget in milliseconds for explaining an UNSAT instance, shared by core minimization and the
+# relaxation search. The explanation runs from the GUI, so it must stay short.
+EXPLANATION_TIMEOUT = 10000
+
+
+# Define a class to describe an assertion that is guarded by a tracking literal.
+class TrackedAssertion:
+    def __init__(self, name, literal, description, cost, exams=(), students=(), rooms=(), slots=()):
+        self.name = name  # Unique name of the assertion, also the name of its tracking literal
+        self.literal = literal  # Boolean literal that switches the assertion on when assumed
+        self.description = description  # Human readable description of what is asserted
+        self.cost = cost  # Cost of dropping this assertion in a relaxation, or NOT_RELAXABLE
+
+        # Exams, students, rooms and slots that the assertion talks about. Constraint groups name no exams,
+        # students or rooms; the slot-based groups (C4, C6, C8) name the slots they have to fit into.
+        self.exams = tuple(exams)
+        self.students = tuple(students)
+        self.rooms = tuple(rooms)
+        self.slots = tuple(slots)
+
 
-def solve(instance):
+# Define a class to hold the structured explanation of why an instance is UNSAT.
+class Explanation:
+    def __init__(self, cores, minimal, relaxation=None, lower_bound=0, relaxable=True):
+        self.cores = cores  # Lists of tracked assertions that conflict with each other, one list per conflict
+        self.minimal = minimal  # For each core, whether it is proven minimal (no check ran out of time)
+        self.relaxation = relaxation  # List of tracked assertions to drop, or None if none was found in time
+        self.lower_bound = lower_bound  # Proven lower bound on the cost of any relaxation
+        self.relaxable = relaxable  # False if it is proven that no relaxation exists
+
+        # Collect the exams, students, rooms and slots named by the conflicting assertions
+        self.exams = sorted({e for core in cores for a in core for e in a.exams})
+        self.students = sorted({st for core in cores for a in core for st in a.students})
+        self.rooms = sorted({r for core in cores for a in core for r in a.rooms})
+        self.slots = sorted({t for core in cores for a in core for t in a.slots})
+
+    def __str__(self):
+        text = ""
+        for number, (core, minimal) in enumerate(zip(self.cores, self.minimal), start=1):
+            proof = "" if minimal else ", not proven minimal within the time limit"
+            text += f"Conflict #{number} ({len(core)} tracked assertions{proof}):\n"
+            for a in core:
+                text += f"  - {a.name}: {a.description}\n"
+        # Only list the kinds of entities that the conflict actually names
+        named = [f"{kind}: {ids}" for kind, ids in
+                 (("Exams", self.exams), ("Students", self.students), ("Rooms", self.rooms),
+                  ("Slots", self.slots)) if ids]
+        if named:
+            text += "  ".join(named) + "\n"
+        if not self.relaxable:
+            text += "No relaxation exists: every fix would have to drop an assertion that cannot be dropped."
+            return text
+        if self.relaxation is None:
+            text += f"No relaxation found within the time limit; any relaxation costs at least {self.lower_bound}."
+            return text
+        cost = sum(a.cost for a in self.relaxation)
+        if cost == self.lower_bound:
+            text += f"Cheapest relaxation (cost {cost}): "
+        else:
+            text += f"Relaxation (cost {cost}, the cheapest costs at least {self.lower_bound}): "
+        text += f"drop {', '.join(a.name for a in self.relaxation)}"
+        return text
+
+
+def solve(instance, explain=False):
     s = Solver()  # Create a Z3 solver instance
 
+    # Every constraint group and data fact is asserted as Implies(literal, formula) so that the solver can
+    # switch it on through check() assumptions and report it in an unsat core when it causes a conflict.
+    tracked = {}
+
+    def track(name, formula, description, cost, exams=(), students=(), rooms=(), slots=()):
+        literal = Bool(name)
+        s.add(Implies(literal, formula))
+        tracked[name] = TrackedAssertion(name, literal, description, cost, exams, students, rooms, slots)
+
+    all_rooms = range(instance.number_of_rooms)
+    all_slots = range(instance.number_of_slots)
+
     # Declare Z3 integer variables
     exam = Int('exam')
     room = Int('room')
@@ -48,10 +133,14 @@ def solve(instance):
 
     # Add constraints to link students to their exams
     for etos in instance.exams_to_students:
-        s.add(exam_student(etos[0], etos[1]))
+        name = f"enrolment[exam {etos[0]}, student {etos[1]}]"
+        if name not in tracked:  # Skip duplicate lines in the instance file
+            track(name, exam_student(etos[0], etos[1]), f"student {etos[1]} takes exam {etos[0]}",
+                  FACT_RELAXATION_COST, exams=[etos[0]], students=[etos[1]])
 
     # Constraint 1: Each exam must be timetabled in exactly one room and exactly one slot.
-    s.add(
+    track(
+        "C1",
         ForAll([exam],
                Implies(
                    exam_range(exam),
@@ -64,17 +153,29 @@ def solve(instance):
                           )
                           )
                )
-               )
+               ),
+        "each exam must be timetabled in exactly one room and exactly one slot",
+        NOT_RELAXABLE
     )
 
-    # Constraint 2: There can be, at most, one exam timetabled in a room within a specific slot.
+    # Constraint 3: The number of students taking an exam cannot exceed the capacity of the room.
+    # Tracked per exam, so that a conflict names the exam and the rooms that are too small for it.
+    # The head-count is taken from the enrolment literals, so dropping an enrolment also frees a seat.
     for ex2 in range(instance.number_of_exams):
-        for rm2 in range(instance.number_of_rooms):
-            s.add(Implies((examroom(ex2) == rm2), instance.student_exam_capacity[ex2]
-                          <= instance.room_capacities[rm2]))
+        students_of_exam = sorted({st for e, st in instance.exams_to_students if e == ex2})
+        head_count = Sum([If(tracked[f"enrolment[exam {ex2}, student {st}]"].literal, 1, 0)
+                          for st in students_of_exam] + [IntVal(0)])
+        small_rooms = [rm2 for rm2 in all_rooms
+                       if instance.student_exam_capacity[ex2] > instance.room_capacities[rm2]]
+        track(f"C3[exam {ex2}]",
+              And([Implies((examroom(ex2) == rm2), head_count <= instance.room_capacities[rm2])
+                   for rm2 in all_rooms]),
+              f"exam {ex2} has {instance.student_exam_capacity[ex2]} students and cannot use rooms {small_rooms}",
+              FACT_RELAXATION_COST, exams=[ex2], rooms=small_rooms)
 
-    # Constraint 3: The number of students taking an exam cannot exceed the capacity of the room.
-    s.add(
+    # Constraint 2: There can be, at most, one exam timetabled in a room within a specific slot.
+    track(
+        "C2",
         ForAll([room, ts],
                Implies(
                    And(room_range(room), time_slot_range(ts)),
@@ -89,11 +190,14 @@ def solve(instance):
                           )
                           )
                )
-               )
+               ),
+        "at most one exam can be timetabled in a room within a specific slot",
+        GROUP_RELAXATION_COST
     )
 
     # Constraint 4: A student cannot take exams in consecutive time slots.
-    s.add(
+    track(
+        "C4",
         ForAll(
             [student, nex, ts, nts, exam],
             Implies(
@@ -115,12 +219,16 @@ def solve(instance):
                     And((ts + 1 != nts), (ts - 1 != nts), (ts != nts))
                 )
             )
-        )
+        ),
+        f"a student cannot take exams in the same or consecutive time slots, "
+        f"and there are only {instance.number_of_slots} slots",
+        GROUP_RELAXATION_COST, slots=all_slots
     )
 
     # Constraint 5: each room in a given time slot is assigned an invigilator,
     # and that the same invigilator is not assigned to multiple rooms in the same time slot.
-    s.add(
+    track(
+        "C5",
         ForAll([room, ts],  # For all rooms and time slots
                Implies(
                    And(room_range(room), time_slot_range(ts)),  # If the room and time slot are valid
@@ -140,22 +248,28 @@ def solve(instance):
                           )
                           )
                )
-               )
+               ),
+        f"each room in each slot needs its own invigilator out of {num_invigilators - 1}",
+        GROUP_RELAXATION_COST
     )
 
     # Constraint 6: A student can take at most two exams in a day.
-    s.add(
+    track(
+        "C6",
         ForAll([student, ts],  # For each student and time slot
                Implies(
                    student_range(student),  # If the student is valid
                    Sum([If(And(exam_time(exam) == ts, exam_student(exam, student)), 1, 0)
                         for exam in range(instance.number_of_exams)]) <= 2  # No more than 2 exams per day
                )
-               )
+               ),
+        f"a student can take at most two exams in any of the {instance.number_of_slots} slots",
+        GROUP_RELAXATION_COST, slots=all_slots
     )
 
     # Constraint 7: An invigilator can supervise at most 3 exams
-    s.add(
+    track(
+        "C7",
         ForAll([invigilator],
                Implies(
                    invigilator_range(invigilator),  # If the invigilator is valid
@@ -169,12 +283,15 @@ def solve(instance):
                            for ts in range(instance.number_of_slots)]
                    ) <= max_exams_per_invigilator  # Limit the exams supervised by the invigilator
                )
-               )
+               ),
+        f"an invigilator can supervise at most {max_exams_per_invigilator} exams",
+        GROUP_RELAXATION_COST
     )
 
     # Constraint 8: Minimum Breaks Between Supervision
     # An invigilator must have at least one time slot gap between two exams they supervise.
-    s.add(
+    track(
+        "C8",
         ForAll([invigilator, ts1, ts2],
                Implies(
                    And(
@@ -193,7 +310,10 @@ def solve(instance):
                        Abs(ts1 - ts2) > 1  # Require at least one time slot gap
                    )
                )
-               )
+               ),
+        f"an invigilator must have at least one time slot gap between two exams they supervise, "
+        f"and there are only {instance.number_of_slots} slots",
+        GROUP_RELAXATION_COST, slots=all_slots
     )
 
     # Print "loading solutions..." before checking satisfiability
@@ -208,11 +328,16 @@ def solve(instance):
     # Maximum number of solutions to display
     max_solutions = 3
 
-    if s.check() == unsat:
+    # Assume every tracked assertion, so the instance is solved with all constraints and data in force
+    assumptions = [a.literal for a in tracked.values()]
+
+    if s.check(assumptions) == unsat:
+        if explain:
+            return explain_unsat(s, tracked)  # Return the structured Explanation instead of the bare 'UNSAT'
         return 'UNSAT'
     else:
         result = 'SAT\n'
-        while s.check() == sat and solution_count < max_solutions:
+        while s.check(assumptions) == sat and solution_count < max_solutions:
             model = s.model()
             solution = []
             for ex2 in range(instance.number_of_exams):
@@ -246,3 +371,115 @@ def solve(instance):
                 result += "――――――――――――――――――――――――――――――――――――――――――――――――――――"
 
         return result
+
+
+# Function to explain why the tracked assertions of an UNSAT instance cannot all hold.
+def explain_unsat(s, tracked, timeout=EXPLANATION_TIMEOUT):
+    """
+    Extract minimal unsat cores and the cheapest relaxation, reusing the solver that has just returned UNSAT.
+    Every check only changes the assumed tracking literals, so the solver keeps what it has learnt so far.
+    All checks share one time budget of `timeout` milliseconds.
+    """
+    deadline = timer() + timeout / 1000
+    try:
+        core, minimal = minimize_core(s, s.unsat_core(), deadline)
+        cores, minimal_cores, relaxation, lower_bound, relaxable = cheapest_relaxation(s, tracked, core, minimal,
+                                                                                       deadline)
+    finally:
+        s.set(timeout=4294967295)  # Restore Z3's default of no time limit
+
+    # Report the first core, plus for every dropped assertion the first core that dropping it resolves
+    core_names = [[str(literal) for literal in c] for c in cores]
+    reported = [0]
+    for name in relaxation or []:
+        index = next((i for i, names in enumerate(core_names) if name in names), None)
+        if index is not None and index not in reported:
+            reported.append(index)
+    return Explanation([[tracked[name] for name in core_names[i]] for i in reported],
+                       [minimal_cores[i] for i in reported],
+                       None if relaxation is None else [tracked[name] for name in relaxation],
+                       lower_bound, relaxable)
+
+
+# Function to check the given assumptions with whatever is left of the time budget.
+def check_before(s, assumptions, deadline):
+    remaining = int((deadline - timer()) * 1000)
+    if remaining <= 0:
+        return unknown  # The budget is spent, so give up without calling the solver
+    s.set(timeout=remaining)
+    return s.check(assumptions)
+
+
+# Function to shrink an unsat core until dropping any one of its literals makes it satisfiable.
+# Also returns whether every check was decided, i.e. whether the returned core is proven minimal.
+def minimize_core(s, core, deadline):
+    core = list(core)
+    minimal = True
+    i = 0
+    while i < len(core):
+        candidate = core[:i] + core[i + 1:]  # Try the core without its i-th literal
+        result = check_before(s, candidate, deadline)
+        if result == unsat:
+            # Still UNSAT: keep only the literals of the (possibly smaller) core reported for the candidate
+            reported = {str(literal) for literal in s.unsat_core()}
+            core = [literal for literal in candidate if str(literal) in reported]
+        else:
+            if result == unknown:
+                minimal = False  # The check was inconclusive, so the literal may not be needed after all
+            i += 1  # The literal is needed (or could not be shown to be unneeded), so keep it
+    return core, minimal
+
+
+# Function to find the cheapest set of tracked assertions whose removal makes the instance satisfiable.
+def cheapest_relaxation(s, tracked, core, minimal, deadline):
+    """
+    Implicit hitting set search: the cheapest set of assertions hitting every core found so far is dropped from the
+    assumptions; if the rest is still UNSAT, its minimized core is added and the search repeats.
+    Returns the cores found, whether each of them is proven minimal, the names of the assertions to drop (None if
+    none was found), a proven lower bound on the cost of any relaxation and whether a relaxation may exist at all.
+    """
+    # One small Optimize over "drop" literals picks the hitting sets; it only ever gains clauses
+    hitting = Optimize()
+    drop = {name: Bool(f"drop {name}") for name in tracked}
+    for name, a in tracked.items():
+        if a.cost is NOT_RELAXABLE:
+            hitting.add(Not(drop[name]))
+    hitting.minimize(Sum([If(drop[name], a.cost, 0) for name, a in tracked.items()
+                          if a.cost is not NOT_RELAXABLE] + [IntVal(0)]))
+
+    cores = []
+    minimal_cores = []
+    lower_bound = 0
+    skipped = False  # Whether an undecided candidate has been excluded, which stops lower_bound from growing
+
+    while True:
+        cores.append(core)
+        minimal_cores.append(minimal)
+        hitting.add(Or([drop[str(literal)] for literal in core]))
+
+        while True:
+            if hitting.check() != sat:
+                # No candidate is left. Unless undecided candidates were excluded, every way of hitting the
+                # cores drops an assertion that cannot be dropped, so no relaxation exists at all.
+                return cores, minimal_cores, None, lower_bound, skipped
+            model = hitting.model()
+            relaxation = [name for name in tracked if is_true(model.eval(drop[name]))]
+            cost = sum(tracked[name].cost for name in relaxation)
+            if not skipped:
+                lower_bound = cost  # The cheapest hitting set of the cores is a lower bound on any relaxation
+
+            # Solve again with every other tracked assertion still assumed
+            result = check_before(s, [a.literal for name, a in tracked.items() if name not in relaxation], deadline)
+            if result != unknown:
+                break
+            if timer() >= deadline:
+                return cores, minimal_cores, None, lower_bound, True
+
+            # The solver gave up on this candidate: exclude exactly this set of dropped assertions and try the next
+            skipped = True
+            hitting.add(Or([Not(drop[name]) if name in relaxation else drop[name]
+                            for name, a in tracked.items() if a.cost is not NOT_RELAXABLE]))
+
+        if result == sat:
+            return cores, minimal_cores, relaxation, lower_bound, True
+        core, minimal = minimize_core(s, s.unsat_core(), deadline)
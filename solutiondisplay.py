@@ -4,7 +4,7 @@ import re  # Import the 're' module for regular expressions.
 import tkinter as tk  # Import the 'tkinter' module for GUI functionality.
 
 from readfile import read_file  # Import the 'read_file' function from the 'readfile.py' module.
-from constraints import solve  # Import the 'solve' function from the 'constraints.py' module.
+from constraints import solve, Explanation  # Import 'solve' and the 'Explanation' class from 'constraints.py'.
 
 
 # Natural sort helper function
@@ -116,10 +116,15 @@ def display_solution_for_selected_instance(instances_dir, file_var):
             print(f"{selected_instance}: ", end="")  # Print the filename.
 
             start = timer()  # Start the timer.
-            # Call the solve function to get the solution.
-            result = solve(instance)
+            # Call the solve function to get the solution, explaining the conflict if the instance is UNSAT.
+            # The explanation is bounded by EXPLANATION_TIMEOUT (10 seconds) on top of the solve itself.
+            result = solve(instance, explain=True)
             end = timer()  # End the timer.
 
+            # An UNSAT instance comes back as an Explanation object; turn it into text for printing.
+            if isinstance(result, Explanation):
+                result = 'UNSAT\n' + str(result)
+
             print(result)  # Print the result returned by solve.
 
             # Calculate and display elapsed time.